@@ -1,8 +1,14 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import numpy as np
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+import json
 from pydantic import BaseModel
-from openai import AzureOpenAI
-import requests, os, urllib.parse
+from openai import AsyncAzureOpenAI
+import httpx, orjson, os, urllib.parse
 from dotenv import load_dotenv
 from azure.storage.blob import BlobServiceClient
 
@@ -21,21 +27,49 @@ EMBED_KEY       = os.getenv("EMBED_KEY")
 CHAT_ENDPOINT   = os.getenv("CHAT_ENDPOINT")
 CHAT_KEY        = os.getenv("CHAT_KEY")
 
-# 4. Blob Storage
+# 4. Local query embedder (optional): a Text Embeddings Inference sidecar, e.g. http://tei:80.
+# Embedding a short query locally takes ~5ms vs a ~300ms Azure round trip. Only enable this
+# once the index is (re)built with the same model TEI serves — search and ingest must share
+# one embedding space. Unset = keep using Azure.
+TEI_ENDPOINT    = os.getenv("TEI_ENDPOINT")
+
+# 5. Blob Storage
 BLOB_CONN_STR   = os.getenv("BLOB_CONN_STR")
 BLOB_CONTAINER  = os.getenv("BLOB_CONTAINER")
 BLOB_ACCOUNT    = os.getenv("BLOB_ACCOUNT")   # For assembling linear chains
 
 # ========= OpenAI Clients =========
-embedding_client = AzureOpenAI(
+embedding_client = AsyncAzureOpenAI(
     api_key=EMBED_KEY, api_version="2024-02-01", azure_endpoint=EMBED_ENDPOINT
 )
-chat_client = AzureOpenAI(
+chat_client = AsyncAzureOpenAI(
     api_key=CHAT_KEY, api_version="2024-02-01", azure_endpoint=CHAT_ENDPOINT
 )
 
+# ========= Blob Client =========
+# Built once at import: parsing the connection string and building the
+# pipeline/HTTP session per request is wasted work
+blob_service = BlobServiceClient.from_connection_string(BLOB_CONN_STR)
+blob_container = blob_service.get_container_client(BLOB_CONTAINER)
+
 # ========= FastAPI Initialization =========
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared async HTTP client for Azure Search: keep-alive + connection pooling,
+    # closed cleanly on shutdown
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=50),
+        headers={"Content-Type": "application/json", "api-key": SEARCH_KEY}
+    )
+    # Separate client for the TEI sidecar — no Azure headers, short timeout
+    app.state.tei = httpx.AsyncClient(base_url=TEI_ENDPOINT, timeout=10) if TEI_ENDPOINT else None
+    yield
+    await app.state.http.aclose()
+    if app.state.tei is not None:
+        await app.state.tei.aclose()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
@@ -45,16 +79,109 @@ class AskRequest(BaseModel):
     top_k: int | None = 5
 
 
+# ========= Query Caches =========
+EMBED_CACHE_SIZE = 4096       # exact-repeat embedding cache (LRU)
+SEM_CACHE_SIZE = 1024         # semantic cache entries (FIFO ring)
+SEM_CACHE_THRESHOLD = 0.97    # cosine similarity needed to reuse cached search results
+
+# Exact repeats: query text -> embedding (LRU, avoids the OpenAI round trip entirely)
+_embed_cache: OrderedDict = OrderedDict()
+
+# Exact repeats of whole queries: query text -> search results. Needs no vector at all,
+# so it can answer while the embedding request is still in flight.
+RESULT_CACHE_SIZE = 1024
+_result_cache: OrderedDict = OrderedDict()
+
+# Near-duplicates: recent query vectors (unit-normalized) + the search results they produced.
+# Stored as float16 — cosine similarity tolerates the precision loss and RAM halves
+# (1024 x 3072 drops from 12 MB to 6 MB per worker). Allocated lazily on first insert:
+# the vector dimension depends on the embedder (Azure: 3072, a TEI sidecar model may differ).
+_sem_matrix = None
+_sem_docs: list = [None] * SEM_CACHE_SIZE
+_sem_topk: list = [None] * SEM_CACHE_SIZE   # top_k each entry was fetched with
+_sem_count = 0
+_sem_next = 0
+
+def _unit(vec: list[float]) -> np.ndarray:
+    q = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(q))
+    return q / norm if norm else q
+
+def semantic_cache_lookup(vec: list[float], top_k: int):
+    """Return cached search results if a recent query vector is cosine-similar enough
+    and its results were fetched with the same top_k"""
+    if _sem_matrix is None or _sem_count == 0 or len(vec) != _sem_matrix.shape[1]:
+        return None
+    q = _unit(vec)
+    # Upcast to float32 for the GEMV — float16 matmul falls back to slow scalar code
+    sims = _sem_matrix[:_sem_count].astype(np.float32) @ q
+    # Entries fetched with a different top_k would return the wrong result size
+    eligible = np.array(_sem_topk[:_sem_count]) == top_k
+    if not eligible.any():
+        return None
+    sims = np.where(eligible, sims, -1.0)
+    best = int(np.argmax(sims))
+    if sims[best] >= SEM_CACHE_THRESHOLD:
+        return _sem_docs[best]
+    return None
+
+def semantic_cache_insert(vec: list[float], top_k: int, docs: list[dict]) -> None:
+    global _sem_matrix, _sem_count, _sem_next
+    if _sem_matrix is None:
+        _sem_matrix = np.zeros((SEM_CACHE_SIZE, len(vec)), dtype=np.float16)
+    elif len(vec) != _sem_matrix.shape[1]:
+        # Embedder changed dimension mid-flight (e.g. TEI fallback) — don't poison the cache
+        return
+    _sem_matrix[_sem_next] = _unit(vec).astype(np.float16)
+    _sem_docs[_sem_next] = docs
+    _sem_topk[_sem_next] = top_k
+    _sem_next = (_sem_next + 1) % SEM_CACHE_SIZE
+    _sem_count = min(_sem_count + 1, SEM_CACHE_SIZE)
+
+
 # ---------- helpers ----------
-def get_embedding(text: str) -> list[float]:
-    resp = embedding_client.embeddings.create(model="text-embedding-3-large", input=text)
-    return resp.data[0].embedding
+async def get_embedding(text: str) -> list[float]:
+    vec = _embed_cache.get(text)
+    if vec is not None:
+        _embed_cache.move_to_end(text)
+        return vec
+    vec = None
+    if app.state.tei is not None:
+        try:
+            r = await app.state.tei.post("/embed", json={"inputs": text})
+            r.raise_for_status()
+            vec = orjson.loads(r.content)[0]
+        except Exception as e:
+            # Sidecar down or slow → fall back to Azure rather than failing the request
+            print("TEI embed failed, falling back to Azure:", e)
+    if vec is None:
+        resp = await embedding_client.embeddings.create(model="text-embedding-3-large", input=text)
+        vec = resp.data[0].embedding
+    _embed_cache[text] = vec
+    if len(_embed_cache) > EMBED_CACHE_SIZE:
+        _embed_cache.popitem(last=False)
+    return vec
 
-def search_docs(query: str, top_k: int = 5):
+async def search_docs(query: str, top_k: int = 5):
     """Call Azure Search to perform hybrid (keyword + vector + semantic reranker)"""
-    vec = get_embedding(query)
+    # Kick off the embedding right away — the exact-repeat lookup below doesn't need it
+    embed_task = asyncio.create_task(get_embedding(query))
+
+    cache_key = (query, top_k)
+    cached = _result_cache.get(cache_key)
+    if cached is not None:
+        _result_cache.move_to_end(cache_key)
+        embed_task.cancel()   # cache answered first, skip the embedding round trip
+        return cached
+
+    vec = await embed_task
+
+    # Near-duplicate question recently answered → reuse its search results
+    cached = semantic_cache_lookup(vec, top_k)
+    if cached is not None:
+        return cached
+
     url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}/docs/search?api-version=2023-07-01-Preview"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
 
     body = {
         "search": query,
@@ -67,51 +194,44 @@ def search_docs(query: str, top_k: int = 5):
         ],
         "queryType": "semantic",   # 🔹Enable semantic search
         "semanticConfiguration": "kattsafe-rag-semantic-configuration",  # 🔹Use the semantic config defined in your index
-        "top": top_k
-        #  Not adding select → defaults to returning all fields, including file, folder, url, page, @search.score
+        "top": top_k,
+        # Only the fields we read — without select Azure returns everything,
+        # including the 3072-dim text_vector (~12KB per hit). @search.score comes back regardless.
+        "select": "file,folder,page,url,chunk"
     }
 
-    r = requests.post(url, headers=headers, json=body, timeout=30)
+    # orjson (C) serializes/parses the big float-array payloads 5-10x faster than stdlib json
+    r = await app.state.http.post(url, content=orjson.dumps(body))
     try:
         r.raise_for_status()
-        return r.json().get("value", [])
-    except requests.exceptions.HTTPError:
+        docs = orjson.loads(r.content).get("value", [])
+        semantic_cache_insert(vec, top_k, docs)
+        _result_cache[cache_key] = docs
+        if len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+        return docs
+    except httpx.HTTPStatusError:
         print("Azure Search Error:", r.status_code, r.text)
         return {"error": r.text, "status_code": r.status_code}
 
 
-def answer_with_gpt(query: str, docs: list[dict]) -> dict:
-    # If no retrieval results or errors occur
-    if not docs or (isinstance(docs, dict) and docs.get("error")):
-        if isinstance(docs, dict) and docs.get("error"):
-            return {
-                "answer": f"Azure Search Error: {docs['error']}",
-                "reference": None,
-                "confidence": 0
-            }
-        system = "You are a helpful assistant."
-        user = f"No relevant documents found. Still answer concisely if you can.\n\nQuestion: {query}"
-        resp = chat_client.chat.completions.create(
-            model="gpt-4.1",
-            messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
-            temperature=0.2
-        )
-        return {
-            "answer": resp.choices[0].message.content,
-            "reference": None,
-            "confidence": 0
-        }
-
-    # Concatenate multiple search results as context
+def build_context_messages(query: str, docs: list[dict]) -> list[dict]:
+    """Build the grounded RAG prompt from retrieved chunks (shared by /ask and /ask/stream)"""
+    # Concatenate multiple search results as context, under a hard size budget —
+    # GPT latency scales with prompt tokens, so cap it deterministically
+    budget = 8000  # chars, ≈2000 tokens
     context_parts = []
+    used = 0
     for d in docs[:8]:  # Take the first 8 chunks
         file = d.get("file", "")
         folder = d.get("folder", "")
         page = d.get("page", "")
-        chunk_text = d.get("chunk", "")[:1200]  # Each chunk max 1200 characters
-        context_parts.append(
-            f"[Source: {folder}/{file} | Page {page}]\n{chunk_text}"
-        )
+        chunk_text = d.get("chunk", "")  # Chunks are capped at 1200 chars at ingest (CHUNK_SIZE)
+        part = f"[Source: {folder}/{file} | Page {page}]\n{chunk_text}"
+        if used + len(part) > budget:
+            break
+        context_parts.append(part)
+        used += len(part)
     context = "\n\n".join(context_parts)
 
     # Construct the prompt
@@ -134,34 +254,65 @@ def answer_with_gpt(query: str, docs: list[dict]) -> dict:
         f"Context:\n{context}\n\nQuestion: {query}\n\nAnswer based ONLY on the context above:"
     )
 
+    return [
+        {"role": "system", "content": "You are a precise assistant."},
+        {"role": "user", "content": user}
+    ]
+
+
+def build_reference(docs: list[dict]) -> tuple[dict, int]:
+    """Reference keeps only the first hit; confidence is its score vs the batch max"""
+    s = docs[0]
+
+    # Calculate confidence percentage (extract scores once, guard against all-zero)
+    scores = [d.get("@search.score", 0) for d in docs]
+    max_score = max(scores, default=1) or 1
+    raw_score = scores[0]
+    confidence = int((raw_score / max_score) * 100)
+
+    reference = {
+        "file": s.get("file", ""),
+        "folder": s.get("folder", ""),
+        "page": s.get("page", ""),
+        "url": s.get("url", "")
+    }
+    return reference, confidence
+
+
+async def answer_with_gpt(query: str, docs: list[dict]) -> dict:
+    # If no retrieval results or errors occur
+    if not docs or (isinstance(docs, dict) and docs.get("error")):
+        if isinstance(docs, dict) and docs.get("error"):
+            return {
+                "answer": f"Azure Search Error: {docs['error']}",
+                "reference": None,
+                "confidence": 0
+            }
+        system = "You are a helpful assistant."
+        user = f"No relevant documents found. Still answer concisely if you can.\n\nQuestion: {query}"
+        resp = await chat_client.chat.completions.create(
+            model="gpt-4.1",
+            messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+            temperature=0.2
+        )
+        return {
+            "answer": resp.choices[0].message.content,
+            "reference": None,
+            "confidence": 0
+        }
+
     # GPT Call
-    resp = chat_client.chat.completions.create(
+    resp = await chat_client.chat.completions.create(
         model="gpt-4.1",
-        messages=[
-            {"role": "system", "content": "You are a precise assistant."},
-            {"role": "user", "content": user}
-        ],
+        messages=build_context_messages(query, docs),
         temperature=0.2,
         max_tokens=1500
     )
-    ans = resp.choices[0].message.content
-
-    # Reference only keeps the first
-    s = docs[0]
-
-    # Calculate confidence percentage
-    max_score = max(d.get("@search.score", 0) for d in docs) or 1
-    raw_score = s.get("@search.score", 0)
-    confidence = int((raw_score / max_score) * 100)
 
+    reference, confidence = build_reference(docs)
     return {
-        "answer": ans,
-        "reference": {
-            "file": s.get("file", ""),
-            "folder": s.get("folder", ""),
-            "page": s.get("page", ""),
-            "url": s.get("url", "")
-        },
+        "answer": resp.choices[0].message.content,
+        "reference": reference,
         "confidence": confidence
     }
 
@@ -170,20 +321,54 @@ def answer_with_gpt(query: str, docs: list[dict]) -> dict:
 
 # ---------- routes ----------
 @app.post("/ask")
-def ask(req: AskRequest):
-    docs = search_docs(req.query, top_k=req.top_k or 5)
-    result = answer_with_gpt(req.query, docs)
+async def ask(req: AskRequest):
+    docs = await search_docs(req.query, top_k=req.top_k or 5)
+    result = await answer_with_gpt(req.query, docs)
     result["hits"] = len(docs)
     result["markdown"] = True   # Clearly inform the front-end that this is Markdown
     return result
 
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest):
+    """SSE variant of /ask: tokens arrive as they are generated (TTFB ≈ first-token time),
+    followed by one final event with reference/confidence metadata"""
+    docs = await search_docs(req.query, top_k=req.top_k or 5)
+
+    # No retrieval results or search error → fall back to the non-streamed answer
+    if not docs or (isinstance(docs, dict) and docs.get("error")):
+        result = await answer_with_gpt(req.query, docs)
+
+        async def fallback():
+            yield f"data: {json.dumps({'answer': result['answer']})}\n\n"
+            done = {"done": True, "reference": result["reference"],
+                    "confidence": result["confidence"], "hits": 0, "markdown": True}
+            yield f"data: {json.dumps(done)}\n\n"
+        return StreamingResponse(fallback(), media_type="text/event-stream")
+
+    reference, confidence = build_reference(docs)
+    stream = await chat_client.chat.completions.create(
+        model="gpt-4.1",
+        messages=build_context_messages(req.query, docs),
+        temperature=0.2,
+        max_tokens=1500,
+        stream=True
+    )
+
+    async def gen():
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield f"data: {json.dumps({'answer': delta})}\n\n"
+        done = {"done": True, "reference": reference,
+                "confidence": confidence, "hits": len(docs), "markdown": True}
+        yield f"data: {json.dumps(done)}\n\n"
+    return StreamingResponse(gen(), media_type="text/event-stream")
+
 @app.get("/list-cloud-pdfs")
 def list_cloud_pdfs():
     try:
-        svc = BlobServiceClient.from_connection_string(BLOB_CONN_STR)
-        cont = svc.get_container_client(BLOB_CONTAINER)
         items = []
-        for b in cont.list_blobs():
+        for b in blob_container.list_blobs():
             if b.name.lower().endswith(".pdf"):
                 items.append({
                     "name": os.path.basename(b.name),
@@ -196,16 +381,15 @@ def list_cloud_pdfs():
         return {"error": str(e), "pdfs": [], "count": 0}
 
 @app.get("/inspect/{pdf_name}")
-def inspect_pdf(pdf_name: str):
+async def inspect_pdf(pdf_name: str):
     safe = pdf_name.replace("'", "''")
     url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}/docs/search?api-version=2023-07-01-Preview"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
     body = {"search": "", "filter": f"file eq '{safe}'", "top": 20, "select": "chunk,file,page,url"}
-    
-    r = requests.post(url, headers=headers, json=body, timeout=30)
+
+    r = await app.state.http.post(url, content=orjson.dumps(body))
     try:
         r.raise_for_status()
-        vals = r.json().get("value", [])
+        vals = orjson.loads(r.content).get("value", [])
         pages = [{"page":v.get("page"), "preview": (v.get("chunk","")[:200]+"..."), "url": v.get("url","")} for v in vals]
         return {"pdf_name": pdf_name, "total_pages": len(pages), "pages": pages}
     except Exception as e:
@@ -0,0 +1,57 @@
+import os
+from dotenv import load_dotenv
+import requests
+
+load_dotenv()
+# ================== 配置 ==================
+SEARCH_ENDPOINT = os.getenv("SEARCH_ENDPOINT")
+SEARCH_INDEX    = os.getenv("SEARCH_INDEX")
+SEARCH_KEY      = os.getenv("SEARCH_KEY")
+
+API_VERSION = "2024-07-01"          # vectorSearch.compressions 需要 2024-07-01 及以上
+COMPRESSION_NAME = "sq-text-vector" # 标量量化（int8）配置名
+
+# ================== 主流程 ==================
+def enable_scalar_quantization() -> None:
+    """
+    一次性脚本：给索引的向量字段挂上标量量化（float32 → int8）。
+    ingest 侧照常上传 float32，服务端入库时压缩，索引内存占用降 4 倍；
+    重排阶段用原始向量补回精度损失。
+    """
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json", "api-key": SEARCH_KEY})
+    url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}?api-version={API_VERSION}"
+
+    r = session.get(url, timeout=30)
+    r.raise_for_status()
+    index = r.json()
+
+    vector_search = index.setdefault("vectorSearch", {})
+    compressions = vector_search.setdefault("compressions", [])
+    if any(c.get("name") == COMPRESSION_NAME for c in compressions):
+        print(f"Compression '{COMPRESSION_NAME}' already configured, nothing to do.")
+        return
+
+    compressions.append({
+        "name": COMPRESSION_NAME,
+        "kind": "scalarQuantization",
+        "rerankWithOriginalVectors": True,  # 🔹重排用原始向量，召回基本不掉
+        "defaultOversampling": 4,
+        "scalarQuantizationParameters": {"quantizedDataType": "int8"}
+    })
+    # 所有向量 profile（text_vector 走的就是这些）都引用该压缩配置
+    for profile in vector_search.get("profiles", []):
+        profile["compression"] = COMPRESSION_NAME
+
+    # 改压缩配置会触发重建，需要允许短暂下线
+    r = session.put(url + "&allowIndexDowntime=true", json=index, timeout=120)
+    try:
+        r.raise_for_status()
+    except Exception:
+        print("Index update error:", r.status_code, r.text[:500])
+        raise
+    print(f"✅ Scalar quantization (int8) enabled on index '{SEARCH_INDEX}'.")
+
+
+if __name__ == "__main__":
+    enable_scalar_quantization()
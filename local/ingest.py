@@ -1,14 +1,20 @@
 import os
 from dotenv import load_dotenv
-import io
+import asyncio
+import hashlib
+import orjson
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import uuid
 import math
+import tempfile
 import time
 import urllib.parse
 import requests
-from typing import List, Dict
-from PyPDF2 import PdfReader
-from azure.storage.blob import ContainerClient
+from typing import List, Dict, Tuple
+import pypdfium2 as pdfium
+from azure.storage.blob.aio import ContainerClient
 from openai import AzureOpenAI
 from tqdm import tqdm
 
@@ -31,23 +37,38 @@ BLOB_PREFIX     = os.getenv("BLOB_PREFIX", "")   # 可选环境变量，默认
 BLOB_ACCOUNT    = os.getenv("BLOB_ACCOUNT")      # 用于拼直链
 
 # Chunking 策略
-CHUNK_SIZE = 1000   # 每段字符数
+CHUNK_SIZE = 1200   # 每段字符数（与 /ask 的上下文上限一致，避免服务端再截断）
 CHUNK_OVERLAP = 100 # 段落重叠，避免割裂
 BATCH_UPLOAD = 500  # 每批最多上传多少个 chunk
+BATCH_EMBED = 128   # 每次 embedding 请求最多带多少段文本（交互式接口用）
+BATCH_POLL_SECONDS = 30  # Batch API 任务轮询间隔
+BATCH_API_MIN_CHUNKS = 512  # 未命中数低于此值走交互式接口（小增量等 24h 窗口不划算）
+INGEST_CONCURRENCY = 8   # 并发处理多少个 PDF（下载+切分都是 I/O 密集）
+UPLOAD_WORKERS = 4       # 并发上传批次数（受 Search 服务端配额限制，别开太大）
+EMBED_CACHE_DB = os.getenv("EMBED_CACHE_DB", "embed_cache.db")  # sha256→向量 本地缓存
 
 # ================== 客户端 ==================
+# api_version 至少要 2024-10-21（GA）：再早的版本没有 files/batches 接口，Batch API 会 404
 embedding_client = AzureOpenAI(
-    api_key=EMBED_KEY, api_version="2024-02-01", azure_endpoint=EMBED_ENDPOINT
+    api_key=EMBED_KEY, api_version="2024-10-21", azure_endpoint=EMBED_ENDPOINT
 )
-blob_container = ContainerClient.from_connection_string(BLOB_CONN_STR, BLOB_CONTAINER)
+# 复用 TCP/TLS 连接（keep-alive），避免每次调用 Azure Search 都重新握手
+SEARCH_SESSION = requests.Session()
+SEARCH_SESSION.headers.update({"Content-Type": "application/json", "api-key": SEARCH_KEY})
+SEARCH_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=50))
 
 # ================== 工具函数 ==================
-def get_embedding(text: str) -> List[float]:
+def get_embeddings_batch(texts: List[str]) -> List[List[float]]:
+    """批量 embedding：一次请求带多段文本（接口支持最多 ~2048 条），按原顺序返回向量"""
+    if not texts:
+        return []
     # 简单的重试
     for attempt in range(3):
         try:
-            resp = embedding_client.embeddings.create(model=EMBED_MODEL, input=text)
-            return resp.data[0].embedding
+            resp = embedding_client.embeddings.create(model=EMBED_MODEL, input=texts)
+            # 按 index 排序，保证与输入顺序一致
+            data = sorted(resp.data, key=lambda d: d.index)
+            return [d.embedding for d in data]
         except Exception as e:
             if attempt == 2:
                 raise
@@ -57,97 +78,109 @@ def split_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP)
     text = (text or "").strip()
     if not text:
         return []
-    chunks = []
-    start = 0
     n = len(text)
-    while start < n:
-        end = min(start + size, n)
-        chunk = text[start:end]
-        chunks.append(chunk)
-        if end == n:
-            break
-        start = end - overlap
-        if start < 0:
-            start = 0
-    return chunks
+    # 偏移量可以直接算出来：步长 size-overlap，最后一段覆盖到结尾即停
+    step = size - overlap
+    starts = range(0, max(n - overlap, 1), step)
+    return [text[s:s+size] for s in starts]
 
 def build_blob_url(blob_name: str, page_num: int) -> str:
     # 对 blob_name 做 URL 编码，避免空格
     encoded_name = urllib.parse.quote(blob_name)
     return f"https://{BLOB_ACCOUNT}.blob.core.windows.net/{BLOB_CONTAINER}/{encoded_name}#page={page_num}"
 
-def search_invalid_docs(top: int = 1000, skip: int = 0) -> List[Dict]:
-    """查找 file==null 或 file=='' 的文档（分页）"""
+def search_invalid_docs(top: int = 1000) -> Tuple[List[Dict], int]:
+    """查找 file==null 或 file=='' 的文档，返回 (本批结果, 匹配总数)"""
     url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}/docs/search?api-version=2023-07-01-Preview"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
     body = {
         "search": "*",
         "filter": "(file eq null) or (file eq '')",
         "top": top,
-        "skip": skip,
+        "count": True,
         "select": "chunk_id,file,page,url"
     }
-    r = requests.post(url, headers=headers, json=body, timeout=30)
+    # orjson（C 实现）比标准库 json 快 5-10 倍，尤其是大的 float 数组
+    r = SEARCH_SESSION.post(url, data=orjson.dumps(body), timeout=30)
     r.raise_for_status()
-    return r.json().get("value", [])
+    data = orjson.loads(r.content)
+    return data.get("value", []), int(data.get("@odata.count", 0))
 
 def delete_docs_by_chunk_ids(chunk_ids: List[str]) -> None:
     if not chunk_ids:
         return
     url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}/docs/index?api-version=2023-07-01-Preview"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
-    actions = [{"@search.action": "delete", "chunk_id": cid} for cid in chunk_ids]
-    r = requests.post(url, headers=headers, json={"value": actions}, timeout=60)
-    r.raise_for_status()
+    # index 接口单次最多接受 1000 个 action
+    for i in range(0, len(chunk_ids), 1000):
+        actions = [{"@search.action": "delete", "chunk_id": cid} for cid in chunk_ids[i:i+1000]]
+        r = SEARCH_SESSION.post(url, data=orjson.dumps({"value": actions}), timeout=60)
+        r.raise_for_status()
 
 def cleanup_invalid_docs() -> int:
-    """循环分页清理，直到没有无效文档"""
+    """批量清理无效文档：用 @odata.count 跟踪剩余量，删完为止"""
     total_deleted = 0
     while True:
-        # 简单分页：每次取 1000 条尝试
-        batch = search_invalid_docs(top=1000, skip=0)
+        batch, matched = search_invalid_docs(top=1000)
         if not batch:
             break
         ids = [doc["chunk_id"] for doc in batch if "chunk_id" in doc]
         delete_docs_by_chunk_ids(ids)
         total_deleted += len(ids)
-        print(f"Deleted {len(ids)} invalid docs (accumulated: {total_deleted})")
+        remaining = max(matched - len(ids), 0)
+        print(f"Deleted {len(ids)} invalid docs (accumulated: {total_deleted}, remaining: {remaining})")
+        if remaining == 0:
+            break
     return total_deleted
 
-def upload_docs_batched(docs: List[Dict], batch_size: int = BATCH_UPLOAD) -> None:
-    url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}/docs/index?api-version=2023-07-01-Preview"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
-    for i in range(0, len(docs), batch_size):
-        batch = docs[i:i+batch_size]
-        r = requests.post(url, headers=headers, json={"value": batch}, timeout=120)
+def _upload_one_batch(url: str, batch: List[Dict]) -> None:
+    for attempt in range(5):
+        r = SEARCH_SESSION.post(url, data=orjson.dumps({"value": batch}), timeout=120)
+        if r.status_code == 429:
+            # 被服务端限流：指数退避后重试
+            time.sleep(2 ** attempt)
+            continue
         try:
             r.raise_for_status()
         except Exception:
             # 打印前 300 字做排查
             print("Index upload error:", r.status_code, r.text[:300])
             raise
+        return
+    r.raise_for_status()
 
-def process_pdf_blob(blob_name: str) -> List[Dict]:
-    """从 Blob 读取 PDF，切分并生成 chunk 文档"""
+def upload_docs_batched(docs: List[Dict], batch_size: int = BATCH_UPLOAD) -> None:
+    url = f"{SEARCH_ENDPOINT}/indexes/{SEARCH_INDEX}/docs/index?api-version=2023-07-01-Preview"
+    batches = [docs[i:i+batch_size] for i in range(0, len(docs), batch_size)]
+    # 批次之间互相独立，用线程池并发发送，叠加网络延迟
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = [pool.submit(_upload_one_batch, url, batch) for batch in batches]
+        for fut in as_completed(futures):
+            fut.result()  # 尽早暴露失败
+
+async def process_pdf_blob(container: ContainerClient, blob_name: str) -> Tuple[List[Dict], List[str]]:
+    """从 Blob 读取 PDF，切分并生成 chunk 文档（不含向量），同时返回对应文本"""
     file_name = os.path.basename(blob_name)
     # 提取 folder 名称（顶级目录）
     folder = os.path.dirname(blob_name).split("/")[0] if "/" in blob_name else ""
     print(f"Processing: {file_name} (folder={folder})")
 
-    stream = io.BytesIO(blob_container.download_blob(blob_name).readall())
-    reader = PdfReader(stream)
+    downloader = await container.download_blob(blob_name)
+    # 流式写入 SpooledTemporaryFile：小文件留在内存，大 PDF 落盘，避免 readall 双倍缓冲
+    buf = tempfile.SpooledTemporaryFile(max_size=8 << 20)
+    await downloader.readinto(buf)
+    buf.seek(0)
+    pdf = pdfium.PdfDocument(buf)  # PDFium（C++）解析，比纯 Python 快一个量级
     docs = []
+    texts = []
 
-    for page_idx, page in enumerate(reader.pages, start=1):
+    for page_idx in range(1, len(pdf) + 1):
         try:
-            text = page.extract_text()
+            text = pdf[page_idx - 1].get_textpage().get_text_range()
         except Exception:
             text = ""
         if not text:
             continue
 
         for piece in split_text(text):
-            vec = get_embedding(piece)
             docs.append({
                 "@search.action": "upload",
                 "chunk_id": str(uuid.uuid4()),
@@ -157,38 +190,163 @@ def process_pdf_blob(blob_name: str) -> List[Dict]:
                 "title": file_name,
                 "page": page_idx,
                 "url": build_blob_url(blob_name, page_idx),
-                "chunk": piece,
-                "text_vector": vec
+                "chunk": piece
+                # text_vector 由调用方批量填充
             })
-    return docs
+            texts.append(piece)
+
+    pdf.close()
+    buf.close()
+    return docs, texts
+
+
+def embed_docs(docs: List[Dict], texts: List[str]) -> None:
+    """按 BATCH_EMBED 批量请求 embedding，把向量按原顺序填回 docs（交互式接口）"""
+    for i in range(0, len(texts), BATCH_EMBED):
+        vecs = get_embeddings_batch(texts[i:i+BATCH_EMBED])
+        for doc, vec in zip(docs[i:i+BATCH_EMBED], vecs):
+            doc["text_vector"] = vec
 
 
+def _open_embed_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(EMBED_CACHE_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS cache (hash BLOB PRIMARY KEY, vec BLOB)")
+    return conn
+
+def cache_get_vec(conn: sqlite3.Connection, text: str):
+    h = hashlib.sha256(text.encode("utf-8")).digest()
+    row = conn.execute("SELECT vec FROM cache WHERE hash=?", (h,)).fetchone()
+    if row is None:
+        return None
+    # fp16 存储（体积减半），取出时还原成 float32
+    return np.frombuffer(row[0], dtype=np.float16).astype(np.float32).tolist()
+
+def cache_put_vec(conn: sqlite3.Connection, text: str, vec: List[float]) -> None:
+    h = hashlib.sha256(text.encode("utf-8")).digest()
+    conn.execute(
+        "INSERT OR REPLACE INTO cache (hash, vec) VALUES (?, ?)",
+        (h, np.asarray(vec, dtype=np.float16).tobytes())
+    )
+
+def embed_docs_with_cache(docs: List[Dict], texts: List[str]) -> None:
+    """文本没变就不重算：命中 sha256 缓存直接复用向量，未命中的才交给 Batch API"""
+    conn = _open_embed_cache()
+    miss_docs: List[Dict] = []
+    miss_texts: List[str] = []
+    for doc, text in zip(docs, texts):
+        vec = cache_get_vec(conn, text)
+        if vec is not None:
+            doc["text_vector"] = vec
+        else:
+            miss_docs.append(doc)
+            miss_texts.append(text)
+    print(f"Embedding cache: {len(docs) - len(miss_docs)} hits, {len(miss_docs)} misses")
 
-def reingest_from_blob(prefix: str = "") -> int:
+    if miss_docs:
+        # 小增量直接走交互式批量接口；量大才值得等 Batch API 的离线窗口
+        if len(miss_docs) < BATCH_API_MIN_CHUNKS:
+            embed_docs(miss_docs, miss_texts)
+        else:
+            embed_docs_via_batch_api(miss_docs, miss_texts)
+        # 新算出来的向量先落库，再上传
+        for doc, text in zip(miss_docs, miss_texts):
+            cache_put_vec(conn, text, doc["text_vector"])
+        conn.commit()
+    conn.close()
+
+def embed_docs_via_batch_api(docs: List[Dict], texts: List[str]) -> None:
+    """
+    用 Batch API 做离线 embedding（成本减半、配额更高）：
+    上传 JSONL → 创建批任务 → 轮询完成 → 按 custom_id 把向量填回 docs
+    """
+    if not docs:
+        return
+    lines = []
+    for doc, text in zip(docs, texts):
+        lines.append(orjson.dumps({
+            "custom_id": doc["chunk_id"],
+            "method": "POST",
+            "url": "/embeddings",   # Azure 的批处理路由不带 /v1 前缀
+            "body": {"model": EMBED_MODEL, "input": text}
+        }))
+    payload = b"\n".join(lines) + b"\n"
+
+    batch_file = embedding_client.files.create(
+        file=("embeddings.jsonl", payload), purpose="batch"
+    )
+    job = embedding_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/embeddings",
+        completion_window="24h"
+    )
+    print(f"Batch job {job.id}: {len(docs)} chunks submitted, polling...")
+
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_SECONDS)
+        job = embedding_client.batches.retrieve(job.id)
+    if job.status != "completed":
+        raise RuntimeError(f"Embedding batch job {job.id} ended as: {job.status}")
+
+    result = embedding_client.files.content(job.output_file_id)
+    vec_by_id = {}
+    for line in result.text.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        vec_by_id[item["custom_id"]] = item["response"]["body"]["data"][0]["embedding"]
+
+    missing = [doc["chunk_id"] for doc in docs if doc["chunk_id"] not in vec_by_id]
+    if missing:
+        raise RuntimeError(f"Batch job {job.id} returned no embedding for {len(missing)} chunks")
+    for doc in docs:
+        doc["text_vector"] = vec_by_id[doc["chunk_id"]]
+
+
+async def reingest_from_blob(prefix: str = "") -> int:
     """
     遍历整个容器（默认 prefix="" 表示所有），
-    对所有 PDF 重新 ingest，并显示进度
+    并发处理所有 PDF（信号量限流），并显示进度
     """
-    # 先数一数总共有多少 PDF
-    blobs = [b for b in blob_container.list_blobs(name_starts_with=prefix) if b.name.lower().endswith(".pdf")]
-    total_pdfs = len(blobs)
-    print(f"Found {total_pdfs} PDFs to ingest.\n")
-
-    total_chunks = 0
-
-    # tqdm 进度条
-    for blob in tqdm(blobs, desc="Ingesting PDFs", unit="pdf"):
-        blob_name = blob.name
-        docs = process_pdf_blob(blob_name)
-        if docs:
-            upload_docs_batched(docs)
-            total_chunks += len(docs)
-            print(f"✅ {os.path.basename(blob_name)} → {len(docs)} chunks (累积: {total_chunks})")
-        else:
-            print(f"⚠️ Skip {blob_name}: no extractable text.")
+    all_docs: List[Dict] = []
+    all_texts: List[str] = []
+
+    async with ContainerClient.from_connection_string(BLOB_CONN_STR, BLOB_CONTAINER) as container:
+        # 第一阶段：并发下载 + 切分（事件循环同时等多个 TLS 连接）
+        sem = asyncio.Semaphore(INGEST_CONCURRENCY)
+        bar = tqdm(desc="Extracting PDFs", unit="pdf")
+
+        async def _one(blob_name):
+            async with sem:
+                docs, texts = await process_pdf_blob(container, blob_name)
+            if docs:
+                all_docs.extend(docs)
+                all_texts.extend(texts)
+                print(f"✅ {os.path.basename(blob_name)} → {len(docs)} chunks (累积: {len(all_docs)})")
+            else:
+                print(f"⚠️ Skip {blob_name}: no extractable text.")
+            bar.update(1)
+
+        # 边翻页边开任务：list_blobs 还在分页时，前面的 PDF 已经开始处理
+        tasks = []
+        async for blob in container.list_blobs(name_starts_with=prefix):
+            if not blob.name.lower().endswith(".pdf"):
+                continue
+            tasks.append(asyncio.create_task(_one(blob.name)))
+        await asyncio.gather(*tasks)
+        bar.close()
+        total_pdfs = len(tasks)
+        print(f"Found {total_pdfs} PDFs in total.\n")
+
+    if not all_docs:
+        print("\n⚠️ No chunks extracted, nothing to ingest.")
+        return 0
+
+    # 第二阶段：查本地缓存 + 离线 Batch API 统一算向量，再批量上传
+    embed_docs_with_cache(all_docs, all_texts)
+    upload_docs_batched(all_docs)
 
-    print(f"\n✅ Finished ingesting {total_pdfs} PDFs, total {total_chunks} chunks.")
-    return total_chunks
+    print(f"\n✅ Finished ingesting {total_pdfs} PDFs, total {len(all_docs)} chunks.")
+    return len(all_docs)
 
 
 # ================== 主流程 ==================
@@ -198,6 +356,6 @@ if __name__ == "__main__":
     print(f"✅ Cleaned {deleted} docs with empty file field.\n")
 
     print("Step 2/2: Re-ingesting PDFs from Blob (all folders)...")
-    total = reingest_from_blob("")   # 🔹传空字符串，遍历所有 PDF
+    total = asyncio.run(reingest_from_blob(""))   # 🔹传空字符串，遍历所有 PDF
     print(f"✅ Reindexed {total} chunks in total.")
 